@@ -1,70 +1,411 @@
 # app.py
 import streamlit as st
 from streamlit_gsheets import GSheetsConnection
+from google.oauth2 import service_account
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from google.auth.exceptions import GoogleAuthError
 import pandas as pd
-from datetime import date, datetime
+import numpy as np
+import pyarrow as pa
+from numba import get_num_threads, njit, prange
+import hashlib
+import re
+import threading
+import time
+from pathlib import Path
+from datetime import date, datetime, timezone
 from dateutil.relativedelta import relativedelta
 
 st.set_page_config(page_title="Accounting — gsheets-connection", layout="centered")
 
 st.title("Quick Accounting — Streamlit GSheetsConnection")
 
+# Header order of the Transactions worksheet (columns A:H)
+COLUMNS = ["txn_date","type","amount","payment_mode","description","account","sub_account","created_at"]
+# Header of the Balances worksheet: one running net per (account, "YYYY-MM"), kept in step with appends
+BALANCE_COLUMNS = ["account", "year_month", "net"]
+# write requests one Balances update can make (batchUpdate of existing months + append of new ones)
+BALANCE_UPDATE_WRITES = 2
+SHEETS_SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive.metadata.readonly",
+]
+
+# Sheets allows 60 writes/min per user; burst + 60 s of refill stays within that
+WRITE_QUOTA_PER_MIN = 60
+WRITE_BURST = 10
+WRITE_RATE_PER_S = (WRITE_QUOTA_PER_MIN - WRITE_BURST) / 60
+
+# Parsed sheets are kept on disk per spreadsheet revision so a cold start can skip the download
+CACHE_DIR = Path.home() / ".cache" / "my_test_app"
+# part of the cache key: bump whenever the columns/dtypes load_sheet_df returns change
+CACHE_VERSION = 1
+
 # Create connection object (this reads the connection configured in Streamlit secrets)
 conn = st.connection("gsheets", type=GSheetsConnection)
 
-# Helper: read the entire worksheet as a DataFrame
+class TokenBucket:
+    """Thread-safe token bucket refilling `rate` tokens/s up to `capacity`.
+
+    `acquire` reserves its tokens immediately (the balance may go negative) and
+    then sleeps until the reservation is covered, so concurrent callers queue up
+    in arrival order instead of all retrying at once. `release` hands back tokens
+    that were reserved but not spent.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, n=1):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= n
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+
+    def release(self, n=1):
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + n)
+
+# NaT as stored in an int64 view of a datetime64 column
+NAT_I8 = np.iinfo(np.int64).min
+
+# One parallel pass: per-account carry (< lo) and month ([lo, hi)) sums; NaN account -> last slot
+@njit(parallel=True, cache=True)
+def per_account_summary(acct_codes, dates_i8, signed, lo, hi, n_acct, n_chunks):
+    n = dates_i8.shape[0]
+    step = (n + n_chunks - 1) // n_chunks
+    carry = np.zeros((n_chunks, n_acct))
+    month = np.zeros((n_chunks, n_acct))
+    for k in prange(n_chunks):
+        for i in range(k * step, min(n, (k + 1) * step)):
+            d = dates_i8[i]
+            if d == NAT_I8:
+                continue
+            a = acct_codes[i]
+            if a < 0:
+                a = n_acct - 1
+            if d < lo:
+                carry[k, a] += signed[i]
+            elif d < hi:
+                month[k, a] += signed[i]
+    return carry.sum(axis=0), month.sum(axis=0)
+
+# One bucket per server process, shared by every session (a module global would be rebuilt each rerun)
+@st.cache_resource
+def write_bucket():
+    return TokenBucket(rate=WRITE_RATE_PER_S, capacity=WRITE_BURST)
+
+# One lock per server process around ledger appends and Balances read-modify-writes
+@st.cache_resource
+def balances_lock():
+    return threading.Lock()
+
+# Helper: spreadsheet id from the connection secrets (accepts either a full URL or a bare key)
+def spreadsheet_id():
+    spreadsheet = st.secrets["connections"]["gsheets"]["spreadsheet"]
+    m = re.search(r"/spreadsheets/d/([a-zA-Z0-9-_]+)", spreadsheet)
+    return m.group(1) if m else spreadsheet
+
+# Helper: raw Sheets v4 client for the write path, one per session
+def sheets_service():
+    if "sheets_service" not in st.session_state:
+        st.session_state.sheets_service = build("sheets", "v4", credentials=service_credentials(), cache_discovery=False)
+    return st.session_state.sheets_service
+
+# Helper: Drive v3 client (per session, like sheets_service) used for the spreadsheet's revision
+def drive_service():
+    if "drive_service" not in st.session_state:
+        st.session_state.drive_service = build("drive", "v3", credentials=service_credentials(), cache_discovery=False)
+    return st.session_state.drive_service
+
+# Helper: service-account credentials from the connection secrets
+def service_credentials():
+    info = dict(st.secrets["connections"]["gsheets"])
+    return service_account.Credentials.from_service_account_info(info, scopes=SHEETS_SCOPES)
+
+# Helper: Drive modifiedTime of the spreadsheet, or None (with a warning) when it can't be fetched
+def sheet_revision():
+    try:
+        meta = drive_service().files().get(fileId=spreadsheet_id(), fields="modifiedTime").execute()
+    except (HttpError, GoogleAuthError) as e:
+        st.warning(f"Could not read the spreadsheet revision, skipping the disk cache: {e}")
+        return None
+    return meta.get("modifiedTime")
+
+# Helper: parquet path for the current revision of the spreadsheet (None disables the disk cache)
+def sheet_cache_path():
+    revision = sheet_revision()
+    if revision is None:
+        return None
+    spreadsheet = st.secrets.get("connections", {}).get("gsheets", {}).get("spreadsheet", "")
+    digest = hashlib.sha256(f"{CACHE_VERSION}||{spreadsheet}||{revision}".encode()).hexdigest()
+    return CACHE_DIR / f"{digest}.parquet"
+
+# Helper: store df as the only cached revision; the disk cache is best-effort
+def save_sheet_cache(df, path):
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        df.to_parquet(tmp, compression="zstd")
+        tmp.replace(path)
+        for old in path.parent.glob("*.parquet"):
+            if old != path:
+                old.unlink(missing_ok=True)
+    except Exception:
+        pass
+
+# Helper: delete every cached revision (Drive's modifiedTime may lag behind our own writes)
+def drop_sheet_cache():
+    for path in CACHE_DIR.glob("*.parquet"):
+        path.unlink(missing_ok=True)
+
+# Helper: cheap ledger fingerprint (row count + newest created_at) used to key derived caches
+def ledger_revision(df):
+    return f"{len(df)}:{df['created_at'].max()}"
+
+# Helper: apply the ledger dtypes and the signed column (used for both sheet and parquet reads)
+def coerce_sheet_df(df):
+    # keep txn_date as datetime64[ns] (also for an empty sheet) so date filters are int64 compares
+    if "txn_date" in df.columns:
+        df["txn_date"] = pd.to_datetime(df["txn_date"], errors="coerce")
+    if "amount" in df.columns:
+        df["amount"] = pd.to_numeric(df["amount"], errors="coerce").fillna(0.0)
+    # low-cardinality text as categories (integer-code compares, sorted dropdown options)
+    for c in ("type", "payment_mode", "account", "sub_account"):
+        df[c] = df[c].astype("category")
+    # free text as Arrow strings; the columns the numba kernel reads stay NumPy/categorical
+    for c in ("description", "created_at"):
+        df[c] = df[c].astype(pd.ArrowDtype(pa.string()))
+    # signed amount (credit +, debit -); no-credit lookups and NaN codes are both -1, hence the >= 0
+    types = df["type"].cat
+    credit_code = types.categories.get_indexer(["credit"])[0]
+    is_credit = (types.codes.to_numpy() == credit_code) & (credit_code >= 0)
+    df["signed"] = np.where(is_credit, 1.0, -1.0) * df["amount"].to_numpy(dtype=float)
+    df.attrs["revision"] = ledger_revision(df)
+    return df
+
+# Helper: read the entire worksheet as a DataFrame (cached so widget reruns don't refetch the sheet)
+@st.cache_data(ttl=30, show_spinner=False)
 def load_sheet_df():
-    # read entire worksheet "Transactions" (worksheet argument expects a title or gid)
+    cache_path = sheet_cache_path()
+    if cache_path is not None and cache_path.exists():
+        return coerce_sheet_df(pd.read_parquet(cache_path))
+    # read ledger columns A:H of "Transactions"; ttl=0 since caching is done here
     try:
-        df = conn.read(worksheet="Transactions")
+        df = conn.read(worksheet="Transactions", usecols=list(range(len(COLUMNS))), ttl=0)
     except Exception as e:
         st.error(f"Could not read sheet: {e}")
         st.stop()
     # ensure columns exist and dtypes
     if df is None or df.empty:
-        df = pd.DataFrame(columns=["txn_date","type","amount","payment_mode","description","account","sub_account","created_at"])
-    else:
-        if "txn_date" in df.columns:
-            df["txn_date"] = pd.to_datetime(df["txn_date"], errors="coerce").dt.date
-        if "amount" in df.columns:
-            df["amount"] = pd.to_numeric(df["amount"], errors="coerce").fillna(0.0)
+        df = pd.DataFrame(columns=COLUMNS)
+    df = coerce_sheet_df(df)
+    if cache_path is not None:
+        save_sheet_cache(df, cache_path)
     return df
 
+# Helper: read the Balances worksheet; None when it doesn't exist or is still empty
+@st.cache_data(ttl=30, show_spinner=False)
+def load_balances_df():
+    try:
+        balances = conn.read(worksheet="Balances", usecols=list(range(len(BALANCE_COLUMNS))), ttl=0)
+    except Exception:
+        return None
+    if balances is None or balances.empty:
+        return None
+    balances["year_month"] = balances["year_month"].astype(str)
+    balances["net"] = pd.to_numeric(balances["net"], errors="coerce").fillna(0.0)
+    return balances
+
+# Helper: whether the spreadsheet has a Balances tab
+def balances_sheet_exists():
+    meta = sheets_service().spreadsheets().get(spreadsheetId=spreadsheet_id(), fields="sheets.properties.title").execute()
+    return any(sheet["properties"]["title"] == "Balances" for sheet in meta.get("sheets", []))
+
+# Helper: add the nets of appended ledger rows to Balances (caller holds balances_lock); returns writes made
+def update_balances(rows):
+    # Balances is only maintained once it has been built, so it never holds a partial history
+    if not balances_sheet_exists():
+        return 0
+    deltas = {}
+    for row in rows:
+        key = (row["account"], row["txn_date"][:7])
+        sign = 1.0 if row["type"] == "credit" else -1.0
+        deltas[key] = deltas.get(key, 0.0) + sign * row["amount"]
+    values = sheets_service().spreadsheets().values()
+    current = values.get(
+        spreadsheetId=spreadsheet_id(),
+        range="Balances!A2:C",
+        valueRenderOption="UNFORMATTED_VALUE",
+    ).execute().get("values", [])
+    if not current:
+        return 0
+    index = {(str(r[0]), str(r[1])): i for i, r in enumerate(current) if len(r) >= 2}
+    updates, new_rows = [], []
+    for (account, year_month), delta in deltas.items():
+        i = index.get((account, year_month))
+        if i is None:
+            new_rows.append([account, year_month, round(delta, 2)])
+            continue
+        net = float(current[i][2] or 0.0) if len(current[i]) > 2 else 0.0
+        updates.append({"range": f"Balances!C{i + 2}", "values": [[round(net + delta, 2)]]})
+    if updates:
+        values.batchUpdate(
+            spreadsheetId=spreadsheet_id(),
+            body={"valueInputOption": "RAW", "data": updates},
+        ).execute()
+    if new_rows:
+        values.append(
+            spreadsheetId=spreadsheet_id(),
+            range="Balances!A:C",
+            valueInputOption="RAW",
+            insertDataOption="INSERT_ROWS",
+            body={"values": new_rows},
+        ).execute()
+    load_balances_df.clear()
+    return bool(updates) + bool(new_rows)
+
+# Helper: rewrite the Balances worksheet (creating the tab if needed) from a fresh read of the ledger
+def rebuild_balances():
+    write_bucket().acquire(3)
+    values = sheets_service().spreadsheets().values()
+    with balances_lock():
+        if balances_sheet_exists():
+            write_bucket().release(1)
+        else:
+            sheets_service().spreadsheets().batchUpdate(
+                spreadsheetId=spreadsheet_id(),
+                body={"requests": [{"addSheet": {"properties": {"title": "Balances"}}}]},
+            ).execute()
+        load_sheet_df.clear()
+        drop_sheet_cache()
+        df = load_sheet_df()
+        dated = df[df["txn_date"].notna()]
+        nets = dated.groupby(
+            [dated["account"].astype(object).fillna(""), dated["txn_date"].dt.strftime("%Y-%m")]
+        )["signed"].sum()
+        rows = [[account, year_month, round(net, 2)] for (account, year_month), net in nets.items()]
+        values.clear(spreadsheetId=spreadsheet_id(), range="Balances!A:C").execute()
+        values.update(
+            spreadsheetId=spreadsheet_id(),
+            range="Balances!A1",
+            valueInputOption="RAW",
+            body={"values": [BALANCE_COLUMNS] + rows},
+        ).execute()
+        load_balances_df.clear()
+
+# Helper: (carry forward, month net) from Balances; "YYYY-MM" strings order the same as the months
+def summary_from_balances(balances, sel_account, first_day):
+    if sel_account != "-- All --":
+        balances = balances[balances["account"] == sel_account]
+    year_month = first_day.strftime("%Y-%m")
+    carry = balances.loc[balances["year_month"] < year_month, "net"].sum()
+    month = balances.loc[balances["year_month"] == year_month, "net"].sum()
+    return float(carry), float(month)
+
+# Helper: {account: (carry forward, month net)} plus a "-- All --" total, cached per ledger fingerprint and month
+@st.cache_data(ttl=30, max_entries=64, show_spinner=False)
+def account_summaries(_df, df_rev, first_day):
+    next_month = (first_day + relativedelta(months=1)).replace(day=1)
+    accounts = _df["account"].cat
+    carry, month = per_account_summary(
+        accounts.codes.to_numpy(),
+        _df["txn_date"].to_numpy(dtype="datetime64[ns]").view("i8"),
+        _df["signed"].to_numpy(dtype=np.float64),
+        pd.Timestamp(first_day).value,
+        pd.Timestamp(next_month).value,
+        len(accounts.categories) + 1,
+        get_num_threads(),
+    )
+    totals = {name: (float(c), float(m)) for name, c, m in zip(accounts.categories, carry, month)}
+    totals["-- All --"] = (float(carry.sum()), float(month.sum()))
+    return totals
+
+# Helper: write all queued rows with a single append; returns False (rows kept) on failure
+def flush_pending_rows():
+    rows = st.session_state.pending_rows
+    if not rows:
+        return True
+    # one token per write request, taken before the lock for the most a flush can make; unused ones go back
+    write_bucket().acquire(1 + BALANCE_UPDATE_WRITES)
+    with balances_lock():
+        try:
+            # single values.append request: RAW skips server-side parsing, INSERT_ROWS never overwrites
+            sheets_service().spreadsheets().values().append(
+                spreadsheetId=spreadsheet_id(),
+                range="Transactions!A:H",
+                valueInputOption="RAW",
+                insertDataOption="INSERT_ROWS",
+                body={"values": [[row[c] for c in COLUMNS] for row in rows]},
+            ).execute()
+        except Exception as e:
+            st.error(f"Failed to append to sheet: {e}")
+            return False
+        st.session_state.pending_rows = []
+        # drop only the cached sheet (in memory and on disk) so the Summary below picks up the new rows
+        load_sheet_df.clear()
+        drop_sheet_cache()
+        try:
+            write_bucket().release(BALANCE_UPDATE_WRITES - update_balances(rows))
+        except Exception as e:
+            st.warning(f"Saved, but the Balances sheet was not updated ({e}); rebuild it from the Summary")
+    return True
+
+# Rows queued for the next write: the row just submitted plus any earlier rows whose write failed
+if "pending_rows" not in st.session_state:
+    st.session_state.pending_rows = []
+
 # Make entry form compact for mobile
 st.markdown("**New transaction**")
 with st.form("txn_form", clear_on_submit=True):
     c1, c2 = st.columns(2)
     with c1:
-        txn_date = st.date_input("Date", value=date.today())
-        txn_type = st.selectbox("Type", ["debit", "credit"])
-        amount = st.number_input("Amount", min_value=0.0, format="%.2f", step=1.0)
+        txn_date = st.date_input("Date", value=date.today(), key="form_txn_date")
+        txn_type = st.selectbox("Type", ["debit", "credit"], key="form_type")
+        amount = st.number_input("Amount", min_value=0.0, format="%.2f", step=1.0, key="form_amount")
     with c2:
-        payment_mode = st.selectbox("Mode", ["cash", "bank", "upi", "card", "other"])
-        account_choice = st.text_input("Account (type here)", value="")
-        sub_account = st.text_input("Sub-account (optional)")
-        description = st.text_input("Description")
+        payment_mode = st.selectbox("Mode", ["cash", "bank", "upi", "card", "other"], key="form_payment_mode")
+        account_choice = st.text_input("Account (type here)", value="", key="form_account")
+        sub_account = st.text_input("Sub-account (optional)", key="form_sub_account")
+        description = st.text_input("Description", key="form_description")
     submitted = st.form_submit_button("Save")
 
     if submitted:
         account = account_choice.strip()
-        created_at = datetime.utcnow().isoformat()
-        # Row must align with header order used in sheet
+        created_at = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+        # Keys must match COLUMNS; flush_pending_rows writes them in that order
         row = {
             "txn_date": txn_date.isoformat(),
             "type": txn_type,
-            "amount": f"{amount:.2f}",
+            "amount": round(amount, 2),  # native number; the sheet stores it without re-parsing text
             "payment_mode": payment_mode,
             "description": description,
             "account": account,
             "sub_account": sub_account,
             "created_at": created_at,
         }
-        try:
-            # Append row to the Transactions worksheet. `conn.append` will add as a new row.
-            conn.append(worksheet="Transactions", values=[row])
-            st.success("Saved to Google Sheets ✅")
-        except Exception as e:
-            st.error(f"Failed to append to sheet: {e}")
+        st.session_state.pending_rows.append(row)
+
+# Write whatever is queued on every rerun (the new row plus any from a failed write)
+pending = st.session_state.pending_rows
+if pending:
+    if flush_pending_rows():
+        st.success("Saved to Google Sheets ✅")
+    else:
+        st.warning(
+            f"{len(pending)} transaction(s) are NOT saved yet. They are kept only in this browser "
+            "session (lost if you close or reload the page) and are retried on every interaction."
+        )
+        st.button("Retry now", key="retry_pending")
 
 # --- Summary area (carry forward + month totals) ---
 st.markdown("---")
@@ -72,43 +413,34 @@ st.subheader("Summary")
 
 df = load_sheet_df()
 if not df.empty:
-    accounts = sorted(df["account"].dropna().unique().tolist())
-    sel_account = st.selectbox("Account", ["-- All --"] + accounts)
-    month_picker = st.date_input("Month (pick any date in month)", value=date.today())
+    accounts = df["account"].cat.categories.tolist()
+    sel_account = st.selectbox("Account", ["-- All --"] + accounts, key="summary_account")
+    month_picker = st.date_input("Month (pick any date in month)", value=date.today(), key="summary_month")
 
     first_day = month_picker.replace(day=1)
-    next_month = (first_day + relativedelta(months=1)).replace(day=1)
-
-    if sel_account == "-- All --":
-        df_account = df
+    balances = load_balances_df()
+    if balances is not None:
+        carry_forward, month_net = summary_from_balances(balances, sel_account, first_day)
     else:
-        df_account = df[df["account"] == sel_account]
-
-    df_before = df_account[df_account["txn_date"] < first_day]
-    df_month = df_account[(df_account["txn_date"] >= first_day) & (df_account["txn_date"] < next_month)]
-
-    if not df_before.empty:
-        df_before = df_before.copy()
-        df_before["signed"] = df_before.apply(lambda r: float(r["amount"]) if r["type"]=="credit" else -float(r["amount"]), axis=1)
-    else:
-        df_before = pd.DataFrame(columns=df.columns.tolist()+["signed"])
-    if not df_month.empty:
-        df_month = df_month.copy()
-        df_month["signed"] = df_month.apply(lambda r: float(r["amount"]) if r["type"]=="credit" else -float(r["amount"]), axis=1)
-    else:
-        df_month = pd.DataFrame(columns=df.columns.tolist()+["signed"])
-
-    carry_forward = df_before["signed"].sum() if not df_before.empty else 0.0
-    month_net = df_month["signed"].sum() if not df_month.empty else 0.0
+        totals = account_summaries(df, df.attrs["revision"], first_day)
+        carry_forward, month_net = totals.get(sel_account, (0.0, 0.0))
     new_balance = carry_forward + month_net
 
     st.metric("Carry forward", f"{carry_forward:.2f}")
     st.metric("This month net", f"{month_net:.2f}")
     st.metric("New balance", f"{new_balance:.2f}")
+    if st.button("Rebuild balances from transactions", key="rebuild_balances"):
+        try:
+            rebuild_balances()
+            st.success("Balances rebuilt ✅")
+        except Exception as e:
+            st.error(f"Failed to rebuild balances: {e}")
 
     st.markdown("---")
     st.subheader("Recent transactions")
-    show_df = df.sort_values(by=["txn_date"], ascending=False).head(200)
-    st.dataframe(show_df.reset_index(drop=True))
+    # rendered only on request: selecting and serializing 200 rows is the costliest part of a rerun
+    if st.checkbox("Show recent 200", value=False, key="show_recent"):
+        show_df = df.nlargest(200, "txn_date").drop(columns="signed")
+        st.dataframe(pa.Table.from_pandas(show_df, preserve_index=False))
 else:
     st.info("No transactions yet.")